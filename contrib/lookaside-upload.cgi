@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# lookaside-upload.cgi - a stand-in lookaside upload CGI, for testing nbpkg
+#
+# Copyright (C) 2014 Network Box Corporation Limited
+# Author(s): Mathieu Bridon <mathieu.bridon@network-box.com>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+#
+# This implements both the legacy dist-git upload protocol and the chunked one
+# described in src/nbpkg/upload.py, storing files under $LOOKASIDE_DIR with the
+# same layout as the real lookaside cache.
+#
+# To use it locally:
+#     mkdir -p /tmp/lookaside/cgi-bin
+#     cp contrib/lookaside-upload.cgi /tmp/lookaside/cgi-bin/upload.cgi
+#     cd /tmp/lookaside && python -m CGIHTTPServer 8080
+# and set lookaside_cgi = http://localhost:8080/cgi-bin/upload.cgi
+
+import cgi
+import hashlib
+import os
+import shutil
+import sys
+
+
+CACHE_DIR = os.environ.get('LOOKASIDE_DIR', '/tmp/lookaside/pkgs')
+
+
+def send(body, status='200 OK'):
+    sys.stdout.write('Status: %s\r\n' % status)
+    sys.stdout.write('Content-Type: text/plain\r\n\r\n')
+    sys.stdout.write('%s\n' % body)
+    sys.exit(0)
+
+
+def md5_file(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def main():
+    form = cgi.FieldStorage()
+
+    name = form.getvalue('name')
+    md5sum = form.getvalue('md5sum')
+    if not name or not md5sum:
+        send('Required fields: name, md5sum', '400 Bad Request')
+
+    if 'file' in form:
+        filename = os.path.basename(form['file'].filename)
+    else:
+        filename = form.getvalue('filename')
+    if not filename:
+        send('Required field: filename', '400 Bad Request')
+
+    hashdir = os.path.join(CACHE_DIR, name, filename, md5sum)
+    target = os.path.join(hashdir, filename)
+    chunkdir = os.path.join(hashdir, '.chunks')
+
+    # -- Chunked protocol ----------------------------------------------------
+    if form.getvalue('chunks') == 'status':
+        offsets = []
+        if os.path.isdir(chunkdir):
+            offsets = sorted([int(o) for o in os.listdir(chunkdir)
+                              if o.isdigit()])
+        send('CHUNKS\n%s' % '\n'.join(['%d' % o for o in offsets]))
+
+    if form.getvalue('offset') is not None:
+        data = form['file'].file.read()
+        if hashlib.md5(data).hexdigest() != form.getvalue('chunk_md5'):
+            send('Chunk checksum mismatch', '400 Bad Request')
+
+        if not os.path.isdir(chunkdir):
+            os.makedirs(chunkdir)
+
+        offset = int(form.getvalue('offset'))
+        tmppath = os.path.join(chunkdir, '.%d.%d' % (offset, os.getpid()))
+        with open(tmppath, 'wb') as f:
+            f.write(data)
+        os.rename(tmppath, os.path.join(chunkdir, '%d' % offset))
+        send('Chunk %d stored OK' % offset)
+
+    if form.getvalue('assemble'):
+        size = int(form.getvalue('size'))
+        if not os.path.isdir(chunkdir):
+            send('No chunks received', '400 Bad Request')
+
+        offsets = sorted([int(o) for o in os.listdir(chunkdir)
+                          if o.isdigit()])
+
+        tmppath = '%s.%d' % (target, os.getpid())
+        with open(tmppath, 'wb') as out:
+            for offset in offsets:
+                if out.tell() != offset:
+                    os.unlink(tmppath)
+                    send('Missing chunk at offset %d' % out.tell(),
+                         '400 Bad Request')
+                with open(os.path.join(chunkdir, '%d' % offset), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+
+        if os.path.getsize(tmppath) != size or md5_file(tmppath) != md5sum:
+            os.unlink(tmppath)
+            send('Checksum mismatch for the assembled file',
+                 '400 Bad Request')
+
+        os.rename(tmppath, target)
+        shutil.rmtree(chunkdir)
+        send('File %s size %d MD5 %s stored OK' % (filename, size, md5sum))
+
+    # -- Legacy protocol -----------------------------------------------------
+    if 'file' not in form:
+        if os.path.exists(target):
+            send('Available')
+        send('Missing')
+
+    if not os.path.isdir(hashdir):
+        os.makedirs(hashdir)
+
+    tmppath = '%s.%d' % (target, os.getpid())
+    with open(tmppath, 'wb') as out:
+        shutil.copyfileobj(form['file'].file, out)
+
+    if md5_file(tmppath) != md5sum:
+        os.unlink(tmppath)
+        send('MD5 check failed', '400 Bad Request')
+
+    os.rename(tmppath, target)
+    send('File %s size %d MD5 %s stored OK'
+         % (filename, os.path.getsize(target), md5sum))
+
+
+if __name__ == '__main__':
+    main()
@@ -36,8 +36,8 @@ _nbpkg()
     local options="--help -v -q"
     local options_value="--dist --user --path"
     local commands="build chain-build ci clean clog clone co commit compile diff fetchfedora gimmespec giturl help \
-    import install lint local mockbuild new new-sources new-sources-fedora patch prep pull push retire scratch-build sources sourcesfedora \
-    srpm switch-branch tag tag-request unused-patches update upload verify-files verrel"
+    import index install lint local mass-branch mockbuild new new-sources new-sources-fedora patch prefetch prep pull push retire scratch-build sources sourcesfedora \
+    srpm switch-branch tag tag-request unused-patches update upload verify-files verrel watch-tasks"
 
     # parse main options and get command
 
@@ -93,7 +93,7 @@ _nbpkg()
     local after= after_more=
 
     case $command in
-        help|clog|fetchfedora|gimmespec|giturl|lint|mockbuild|new|push|sourcesfedora|unused-patches|update|verrel)
+        help|clog|fetchfedora|gimmespec|giturl|lint|new|push|sourcesfedora|unused-patches|update|verrel|watch-tasks)
             ;;
         build)
             options="--nowait --background --skip-tag --scratch"
@@ -135,6 +135,12 @@ _nbpkg()
             options_branch="--branch"
             after="srpm"
             ;;
+        index)
+            options="build query --retired"
+            options_string="--source --branch --sql"
+            after="file"
+            after_more=true
+            ;;
         lint)
             options="--info"
             ;;
@@ -142,10 +148,26 @@ _nbpkg()
             options="--md5"
             options_arch="--arch"
             ;;
+        mass-branch)
+            options="--verify-only"
+            options_string="--jobs"
+            options_branch="--from"
+            after="package"
+            after_more=true
+            ;;
+        mockbuild)
+            options="--matrix"
+            options_string="--jobs"
+            options_arches="--matrix-arches"
+            ;;
         patch)
             options="--rediff"
             options_string="--suffix"
             ;;
+        prefetch)
+            options="--install-hooks"
+            options_string="--since"
+            ;;
         prep)
             options_arch="--arch"
             ;;
@@ -182,6 +204,7 @@ _nbpkg()
             options_string="--desc --build"
             ;;
         upload|new-sources|new-sources-fedora)
+            options_string="--limit-rate"
             after="file"
             after_more=true
             ;;
@@ -12,14 +12,26 @@
 # This program is based on the GPLv2+-licensed rpkg library by Jesse Keating:
 #     https://fedorahosted.org/rpkg
 
+import multiprocessing
+import multiprocessing.pool
 import os
 import re
+import subprocess
+import time
+import urlparse
 
 import git
 
 import pyrpkg
 
+import artifactcache
 import cli
+import massbranch
+import mirrors
+import prefetch
+import sourcesfile
+import upload
+from metrics import registry
 
 class Commands(pyrpkg.Commands):
     def __init__(self, path, lookaside, lookasidehash, lookaside_cgi,
@@ -27,27 +39,42 @@ class Commands(pyrpkg.Commands):
             build_client,
             # -- nbpkg-specific arguments ------------------------------------
             fedora_lookaside, fedora_lookaside_cgi, fedora_kojiconfig,
-            fedora_anongiturl,
+            fedora_anongiturl, artifact_cache, artifact_cache_rpms,
+            upload_chunk_size, upload_jobs, upload_rate_limit,
+            prefetch_sources, mirror_state,
             # -- end of nbpkg-specific arguments -----------------------------
             user=None, dist=None, target=None, quiet=False):
         """Init the object and some configuration details.
 
         We need to overload this to add our own attributes and properties.
         """
-        super(Commands, self).__init__(path, lookaside, lookasidehash,
-                lookaside_cgi, gitbaseurl, anongiturl, branchre, remote,
-                kojiconfig, build_client, user, dist, target, quiet)
+        # The lookaside can be a list of mirrors, our parent only uses the
+        # first one
+        self.lookaside_mirrors = lookaside.split()
+
+        super(Commands, self).__init__(path, self.lookaside_mirrors[0],
+                lookasidehash, lookaside_cgi, gitbaseurl, anongiturl,
+                branchre, remote, kojiconfig, build_client, user, dist,
+                target, quiet)
 
         # New attributes
         self.fedora_lookaside = fedora_lookaside
         self.fedora_lookaside_cgi = fedora_lookaside_cgi
         self.fedora_kojiconfig = fedora_kojiconfig
         self.fedora_anongiturl = fedora_anongiturl
+        self.artifact_cache = artifact_cache
+        self.artifact_cache_rpms = artifact_cache_rpms
+        self.upload_chunk_size = upload_chunk_size
+        self.upload_jobs = upload_jobs
+        self.upload_rate_limit = upload_rate_limit
+        self.prefetch_sources = prefetch_sources
+        self.mirror_state = mirror_state
 
         # New properties
         self._cert_file = None
         self._ca_cert = None
         self._freedom = None
+        self._artifacts = None
 
         # To interact with the Fedora infrastructure
         self._fedora_remote = None
@@ -252,6 +279,14 @@ class Commands(pyrpkg.Commands):
         else:
             self._freedom = True
 
+    @property
+    def artifacts(self):
+        """Return the artifact cache, or None if it is disabled"""
+        if not self._artifacts and self.artifact_cache:
+            self._artifacts = artifactcache.ArtifactCache(self.artifact_cache,
+                                                          self.log)
+        return self._artifacts
+
     # -- Overloaded features -------------------------------------------------
     def clone(self, module, path=None, branch=None, bare_dir=None, anon=False):
         """Clone a repo, optionally check out a specific branch.
@@ -264,6 +299,33 @@ class Commands(pyrpkg.Commands):
 
         super(Commands, self).clone(module, path, branch, bare_dir, anon)
 
+        if self.prefetch_sources and not bare_dir:
+            prefetch.prefetch(os.path.join(path or self.path, module),
+                              self.lookaside, module, self.lookasidehash,
+                              None, self.log)
+
+    def switch_branch(self, branch, fetch=True):
+        """Switch the working branch
+
+        This overloads the pyrpkg method, to prefetch the new sources.
+        """
+        old_sources = self._read_sources()
+        super(Commands, self).switch_branch(branch, fetch)
+
+        if self.prefetch_sources:
+            self.prefetch(old_sources)
+
+    def pull(self, rebase=False, norebase=False):
+        """Pull changes from the remote repository
+
+        This overloads the pyrpkg method, to prefetch the new sources.
+        """
+        old_sources = self._read_sources()
+        super(Commands, self).pull(rebase, norebase)
+
+        if self.prefetch_sources:
+            self.prefetch(old_sources)
+
     def push(self):
         """Push changes to the remote repository"""
         # First check that we are not pushing to Fedora
@@ -300,18 +362,102 @@ class Commands(pyrpkg.Commands):
         """Fetch sources from a lookaside cache.
 
         We overload it to allow fetching from a different lookaside cache than
-        the configured one.
+        the configured one, or from the best of several mirrors.
+
+        Just like the lookaside setting, lookasideurl can be a
+        whitespace-separated list of mirrors.
         """
+        lookaside_mirrors = self.lookaside_mirrors
         if lookasideurl:
+            lookaside_mirrors = lookasideurl.split()
             old_lookaside = self.lookaside
-            self.lookaside = lookasideurl
+            self.lookaside = lookaside_mirrors[0]
+
+        # Don't start downloading what is already being prefetched
+        entries = sourcesfile.parse_sources(self._read_sources())
+        prefetch.wait(self.path, [f for (h, f) in entries], self.log)
+
+        if len(lookaside_mirrors) > 1:
+            # The mirrors keep track of how much they download themselves
+            with registry.timer('nbpkg_sources_seconds', lookaside='mirrors'):
+                self._mirrored_sources(lookaside_mirrors, outdir or self.path)
+
+        else:
+            # Find out how much we actually download, for the metrics
+            sourcesdir = outdir or self.path
+            before = self._source_sizes(sourcesdir)
+            netloc = urlparse.urlparse(self.lookaside).netloc
 
-        # Don't pass that additional parameter to our parent
-        super(Commands, self).sources(outdir=outdir)
+            # Don't pass that additional parameter to our parent
+            with registry.timer('nbpkg_sources_seconds', lookaside=netloc):
+                super(Commands, self).sources(outdir=outdir)
+
+            after = self._source_sizes(sourcesdir)
+            registry.inc('nbpkg_lookaside_bytes_total',
+                         sum([size for (f, size) in after.items()
+                              if before.get(f) != size]),
+                         lookaside=netloc)
 
         if lookasideurl:
             self.lookaside = old_lookaside
 
+    def srpm(self, hashtype=None):
+        """Create an srpm using hashtype from content in the module
+
+        We overload it to reuse the srpm from the artifact cache when nothing
+        changed in the inputs.
+        """
+        if self.reuse_srpm(hashtype):
+            return
+
+        super(Commands, self).srpm(hashtype)
+
+        if self.artifacts:
+            self.artifacts.store(self._artifact_key('srpm', hashtype),
+                                 self.path, [os.path.basename(self.srpmname)])
+
+    def local(self, arch=None, hashtype=None):
+        """rpmbuild locally for given arch.
+
+        We overload it to reuse the packages from the artifact cache when
+        nothing changed in the inputs.
+        """
+        if self.reuse_local(arch, hashtype):
+            return
+
+        if not self.artifacts or not self.artifact_cache_rpms:
+            return super(Commands, self).local(arch, hashtype)
+
+        before = self._find_rpms()
+        super(Commands, self).local(arch, hashtype)
+        after = self._find_rpms()
+
+        built = [f for f in after if before.get(f) != after[f]]
+        self.artifacts.store(self._artifact_key('local',
+                                                arch or self.localarch,
+                                                hashtype),
+                             self.path, built)
+
+    def load_kojisession(self, anon=False):
+        """Initiate a koji session.
+
+        We overload it to time all the calls to the hub, for the metrics.
+        """
+        super(Commands, self).load_kojisession(anon)
+
+        session = self._anon_kojisession if anon else self._kojisession
+        callMethod = session._callMethod
+
+        def timedCallMethod(name, *args, **kwargs):
+            if session.multicall:
+                # The call is only queued, multiCall itself will be timed
+                return callMethod(name, *args, **kwargs)
+
+            with registry.timer('nbpkg_koji_call_seconds', method=name):
+                return callMethod(name, *args, **kwargs)
+
+        session._callMethod = timedCallMethod
+
     def _create_curl(self, fedora=False):
         """Common curl setup options used for all requests to lookaside.
 
@@ -361,11 +507,32 @@ class Commands(pyrpkg.Commands):
             lookaside_cgi = self.lookaside_cgi
             cert_file = self.cert_file
 
+        # This is overloaded to upload very large files in chunks, if the
+        # lookaside cache supports it (the Fedora one doesn't)
+        if not fedora and self.upload_chunk_size and \
+                os.path.getsize(file) > self.upload_chunk_size:
+            uploader = upload.ChunkedUploader(lookaside_cgi, cert_file,
+                    self.module_name, self.log, self.upload_chunk_size,
+                    jobs=self.upload_jobs, rate_limit=self.upload_rate_limit,
+                    quiet=self.quiet)
+            try:
+                uploader.upload(file, file_hash)
+                return
+
+            except upload.ChunkedUploadUnsupported, e:
+                self.log.debug('Chunked uploads are not supported, falling '
+                               'back to a single request: %s' % e)
+
+            except upload.ChunkedUploadError, e:
+                raise pyrpkg.rpkgError('Could not upload %s: %s' % (file, e))
+
         # This is overloaded to add in the user's cert
         cmd = ['curl', '-k', '--cert', cert_file, '--fail', '-o',
                '/dev/null', '--show-error', '--progress-bar', '-F',
                'name=%s' % self.module_name, '-F', 'md5sum=%s' % file_hash,
                '-F', 'file=@%s' % file]
+        if self.upload_rate_limit:
+            cmd.extend(['--limit-rate', self.upload_rate_limit])
         if self.quiet:
             cmd.append('-s')
         cmd.append(lookaside_cgi)
@@ -418,6 +585,248 @@ class Commands(pyrpkg.Commands):
 
             return desttag.replace('nb', '')
 
+    def _mockconfigs(self, arches):
+        """Find the mock configs for all the dist branches of the module"""
+        mockconfigs = []
+
+        for ref in self.repo.refs:
+            if type(ref) != git.refs.RemoteReference:
+                continue
+
+            remote, branch = ref.name.split('/', 1)
+            if remote != self.remote:
+                continue
+
+            # This must be kept in sync with load_rpmdefines
+            m = re.match(r'nb-fedora(\d\d)$', branch)
+            if m:
+                dist = 'fedora-%s' % m.group(1)
+            else:
+                m = re.match(r'nb-(rhel|epel)(\d)$', branch)
+                if not m:
+                    # NBRS branches are only built in Koji
+                    continue
+                dist = 'epel-%s' % m.group(2)
+
+            for arch in arches:
+                mockconfig = '%s-%s' % (dist, arch)
+                if mockconfig not in mockconfigs:
+                    mockconfigs.append(mockconfig)
+
+        return sorted(mockconfigs)
+
+    def mockbuild_matrix(self, arches, mockargs=[], hashtype=None,
+                         jobs=None):
+        """Build the current spec in mock for every dist branch and arch
+
+        The builds run in parallel, at most jobs at a time (defaulting to the
+        number of CPUs), each in its own chroot. Mock keeps its root and
+        package caches per config rather than per chroot, so they are shared
+        with the regular mockbuild runs of the same config.
+
+        Returns a list of (mockconfig, success, duration) tuples.
+        """
+        mockconfigs = self._mockconfigs(arches)
+        if not mockconfigs:
+            raise pyrpkg.rpkgError('Could not find any branch to build in '
+                                   'mock')
+
+        # Make sure we have an srpm to run on
+        srpm = os.path.join(self.path, '%s-%s-%s.src.rpm' % (self.module_name,
+                                                            self.ver,
+                                                            self.rel))
+        if not os.path.exists(srpm):
+            self.log.debug('No srpm found')
+            self.srpm(hashtype)
+
+        resultdir = os.path.join(self.path, 'results_%s' % self.module_name,
+                                 self.ver, self.rel)
+
+        def build(mockconfig):
+            cmd = ['mock', '-r', mockconfig,
+                   '--uniqueext', 'matrix%d' % os.getpid(),
+                   '--resultdir', os.path.join(resultdir, mockconfig),
+                   '--cleanup-after', '--rebuild', srpm]
+            cmd[1:1] = mockargs
+
+            logfile = os.path.join(resultdir, '%s.log' % mockconfig)
+            self.log.info('Building for %s (see %s)' % (mockconfig, logfile))
+            self.log.debug('Running: %s' % subprocess.list2cmdline(cmd))
+
+            start = time.time()
+            with open(logfile, 'w') as log:
+                ret = subprocess.call(cmd, stdout=log,
+                                      stderr=subprocess.STDOUT)
+            return (mockconfig, ret == 0, time.time() - start)
+
+        if not os.path.isdir(resultdir):
+            os.makedirs(resultdir)
+
+        pool = multiprocessing.pool.ThreadPool(jobs or
+                                               multiprocessing.cpu_count())
+        try:
+            results = pool.map(build, mockconfigs)
+        finally:
+            pool.close()
+            pool.join()
+
+        return results
+
+    def reuse_srpm(self, hashtype=None):
+        """Get the srpm from the artifact cache if nothing changed
+
+        This doesn't need the sources, so it can be tried before downloading
+        them. Returns True if the srpm was found in the cache.
+        """
+        self.srpmname = os.path.join(self.path, '%s-%s-%s.src.rpm'
+                                     % (self.module_name, self.ver, self.rel))
+
+        if not self.artifacts:
+            return False
+
+        if not self.artifacts.fetch(self._artifact_key('srpm', hashtype),
+                                    self.path):
+            return False
+
+        self.log.info('Reusing cached %s' % os.path.basename(self.srpmname))
+        return True
+
+    def reuse_local(self, arch=None, hashtype=None):
+        """Get the packages from the artifact cache if nothing changed
+
+        This doesn't need the sources, so it can be tried before downloading
+        them. Returns True if the packages were found in the cache.
+        """
+        if not self.artifacts or not self.artifact_cache_rpms:
+            return False
+
+        if not self.artifacts.fetch(self._artifact_key('local',
+                                                       arch or self.localarch,
+                                                       hashtype),
+                                    self.path):
+            return False
+
+        self.log.info('Reusing cached packages')
+        return True
+
+    def _artifact_key(self, *extra):
+        """Hash everything which goes into a build
+
+        That is the spec file, the patches and any other tracked file in the
+        module, the sources file (and therefore the hashes of the source
+        tarballs) as well as the rpm defines we build with.
+
+        Untracked files are left out, as they are mostly our own build output.
+        """
+        # Tracked files are still read from the working tree, so uncommitted
+        # changes are taken into account
+        files = self.repo.git.ls_files('--cached', '-z')
+        files = filter(None, files.split('\0'))
+
+        # The same module checked out elsewhere builds the same thing
+        defines = [d.replace(self.path, '%{_topdir}')
+                   for d in self.rpmdefines]
+
+        return artifactcache.hash_inputs(self.path, files,
+                                         defines + list(extra))
+
+    def _find_rpms(self):
+        """Return the rpms under the module directory and their mtimes"""
+        rpms = {}
+
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            if '.git' in dirnames:
+                dirnames.remove('.git')
+
+            for filename in filenames:
+                if filename.endswith('.rpm'):
+                    path = os.path.join(dirpath, filename)
+                    rpms[os.path.relpath(path, self.path)] = \
+                            os.path.getmtime(path)
+
+        return rpms
+
+    def _source_sizes(self, sourcesdir):
+        """Return the sizes of the source files we already have"""
+        sizes = {}
+
+        for file_hash, filename in sourcesfile.parse_sources(
+                                                    self._read_sources()):
+            path = os.path.join(sourcesdir, filename)
+            if os.path.exists(path):
+                sizes[filename] = os.path.getsize(path)
+
+        return sizes
+
+    def _mirrored_sources(self, urls, outdir):
+        """Fetch sources from the best lookaside mirrors"""
+        mirrorset = mirrors.MirrorSet(urls, self.mirror_state, self.log)
+
+        for file_hash, filename in sourcesfile.parse_sources(
+                                                    self._read_sources()):
+            path = os.path.join(outdir, filename)
+            if os.path.exists(path) and sourcesfile.check_hash(path,
+                    file_hash, self.lookasidehash):
+                continue
+
+            self.log.info('Downloading %s' % filename)
+
+            quoted = filename.replace(' ', '%20')
+            try:
+                mirrorset.download('%s/%s/%s/%s' % (self.module_name, quoted,
+                                                    file_hash, quoted), path)
+            except mirrors.MirrorError, e:
+                raise pyrpkg.rpkgError(e)
+
+            if not sourcesfile.check_hash(path, file_hash, self.lookasidehash):
+                os.unlink(path)
+                raise pyrpkg.rpkgError('%s failed checksum' % filename)
+
+    def _read_sources(self):
+        """Return the content of the sources file, if any"""
+        try:
+            with open(os.path.join(self.path, 'sources')) as f:
+                return f.read()
+        except IOError:
+            return ''
+
+    def prefetch(self, old_sources=None):
+        """Download the new sources in the background"""
+        prefetch.prefetch(self.path, self.lookaside, self.module_name,
+                          self.lookasidehash, old_sources, self.log)
+
+    def install_prefetch_hooks(self):
+        """Install the git hooks prefetching the sources"""
+        prefetch.install_hooks(self.path, self.log)
+
+    def mass_branch(self, modules, branch, source, workdir, jobs,
+                    verify_only=False):
+        """Create a new branch from source in all the modules
+
+        The bare repositories and the progress are kept in workdir, and jobs
+        modules are branched at once.
+
+        Returns the number of modules where something went wrong.
+        """
+        if not re.match(self.branchre, branch):
+            raise pyrpkg.rpkgError('%s is not a valid branch name' % branch)
+
+        brancher = massbranch.MassBrancher(self.gitbaseurl, workdir,
+                                           self.log, jobs)
+
+        failed = []
+        if not verify_only:
+            failed = brancher.run(modules, source, branch)
+
+        self.log.info('Verifying the %s branch in %d modules'
+                      % (branch, len(modules)))
+        problems = brancher.verify([m for m in modules if m not in failed],
+                                   branch)
+        for module, problem in problems:
+            self.log.error('%s: %s' % (module, problem))
+
+        return len(failed) + len(problems)
+
     def retire(self, message=None):
         """Delete all tracked files and commit a new dead.package file
 
@@ -15,12 +15,14 @@
 
 import os
 import sys
+import time
 import logging
 import ConfigParser
 import argparse
 
 import pyrpkg
 import nbpkg
+from nbpkg.metrics import registry, get_sink
 
 
 def main():
@@ -43,8 +45,10 @@ def main():
         # The user specified, let's honour his wish
         args.config = NONFREE_CONF
     
-    elif 'clone' in other or 'co' in other:
+    elif 'clone' in other or 'co' in other or 'index' in other or \
+         'mass-branch' in other:
         # Can't autodetect for clone, nonfree has to be specified if necessary
+        # The index spans both free and nonfree, so either config works
         args.config = FREE_CONF
     
     elif os.path.isdir('.git') or args.path:
@@ -115,14 +119,42 @@ def main():
     # We have a logger now, use it to debug the freeness
     log.debug("Using config %s" % args.config)
     
+    # Setup the metrics, which must never prevent the command from running
+    command = client.args.command.__name__
+    try:
+        items = dict(config.items('nbpkg', raw=True))
+        registry.sink = get_sink(items.get('metrics_sink'))
+        registry.labels.update(command=command, remote=items['remote'],
+                               freedom='nonfree' if args.config == NONFREE_CONF
+                                       else 'free')
+    except Exception, e:
+        log.debug('Could not setup the metrics: %s' % e)
+
     # Run the necessary command
+    ret = 0
+    result = 'success'
+    start = time.time()
     try:
-        sys.exit(client.args.command())
+        ret = client.args.command()
     except KeyboardInterrupt:
-        pass
+        result = 'interrupted'
+    except SystemExit, e:
+        ret = e.code
     except Exception, e:
-        log.error('Could not execute %s: %s' % (client.args.command.__name__, e))
-        sys.exit(1)
+        log.error('Could not execute %s: %s' % (command, e))
+        ret = 1
+
+    if ret and result == 'success':
+        result = 'failure'
+
+    registry.inc('nbpkg_commands_total', result=result)
+    registry.observe('nbpkg_command_seconds', time.time() - start)
+    try:
+        registry.flush()
+    except Exception, e:
+        log.debug('Could not write the metrics: %s' % e)
+
+    sys.exit(ret)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,120 @@
+# artifactcache.py - a content-addressed cache for build artifacts
+#
+# Copyright (C) 2014 Network Box Corporation Limited
+# Author(s): Mathieu Bridon <mathieu.bridon@network-box.com>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+"""A cache of build artifacts, keyed on a hash of their inputs.
+
+The cache is a plain directory, which can be shared between hosts (e.g over
+NFS): entries are only ever added by renaming a complete temporary directory
+into place, so readers never see a half-written entry.
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+class ArtifactCache(object):
+    def __init__(self, cachedir, log):
+        self.cachedir = os.path.expanduser(cachedir)
+        self.log = log
+
+    def _entry(self, key):
+        return os.path.join(self.cachedir, key[:2], key)
+
+    def fetch(self, key, destdir):
+        """Copy the artifacts cached for key to destdir
+
+        Returns the list of copied files, relative to destdir, or None if
+        nothing was cached for this key.
+        """
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return None
+
+        fetched = []
+        for dirpath, dirnames, filenames in os.walk(entry):
+            reldir = os.path.relpath(dirpath, entry)
+            for filename in filenames:
+                relpath = os.path.normpath(os.path.join(reldir, filename))
+                dest = os.path.join(destdir, relpath)
+
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+
+                shutil.copy2(os.path.join(dirpath, filename), dest)
+                fetched.append(relpath)
+
+        # Keep track of when entries were last used, to help pruning them
+        os.utime(entry, None)
+
+        self.log.debug('Fetched %s from the artifact cache' % key)
+        return fetched
+
+    def store(self, key, basedir, relpaths):
+        """Store the artifacts (relative to basedir) under key"""
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+
+        parent = os.path.dirname(entry)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        tmpentry = tempfile.mkdtemp(prefix='.%s.' % key, dir=parent)
+
+        try:
+            for relpath in relpaths:
+                dest = os.path.join(tmpentry, relpath)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+
+                shutil.copy2(os.path.join(basedir, relpath), dest)
+
+            os.chmod(tmpentry, 0755)
+            os.rename(tmpentry, entry)
+
+        except OSError as e:
+            # Somebody else stored the same artifacts in the meantime
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+
+        finally:
+            if os.path.isdir(tmpentry):
+                shutil.rmtree(tmpentry)
+
+        self.log.debug('Stored %s in the artifact cache' % key)
+
+
+def hash_inputs(basedir, relpaths, extra=[]):
+    """Hash the content of files and a list of additional values"""
+    h = hashlib.sha256()
+
+    for value in extra:
+        h.update('%s\0' % value)
+
+    for relpath in sorted(relpaths):
+        path = os.path.join(basedir, relpath)
+        if not os.path.isfile(path):
+            # Deleted but not committed yet
+            continue
+
+        h.update('%s\0%d\0' % (relpath, os.path.getsize(path)))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), ''):
+                h.update(chunk)
+
+    return h.hexdigest()
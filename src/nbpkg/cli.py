@@ -17,6 +17,9 @@ import sys
 import os
 import logging
 
+import index
+import taskwatch
+
 
 class nbpkgClient(cliClient):
     def __init__(self, config, name='nbpkg'):
@@ -32,9 +35,37 @@ class nbpkgClient(cliClient):
     def setup_nb_subparsers(self):
         """Register the Network Box specific targets."""
         self.register_fetchfedora()
+        self.register_index()
+        self.register_mass_branch()
         self.register_newsourcesfedora()
+        self.register_prefetch()
         self.register_retire()
         self.register_sourcesfedora()
+        self.register_watch_tasks()
+
+        # Only now do all the targets we extend exist
+        self.extend_mockbuild()
+        self.extend_uploads()
+
+    # -- Extended targets ----------------------------------------------------
+    def extend_mockbuild(self):
+        """Add the matrix options to the mockbuild target."""
+        mockbuild_parser = self.subparsers.choices['mockbuild']
+        mockbuild_parser.add_argument('--matrix', action='store_true',
+                help='Build in parallel for all the dist branches of the '
+                     'module and all the matrix arches')
+        mockbuild_parser.add_argument('--matrix-arches', nargs='*',
+                help='Override the arches to build for in matrix mode')
+        mockbuild_parser.add_argument('--jobs', type=int,
+                help='How many builds to run at once in matrix mode '
+                     '(defaults to the number of CPUs)')
+
+    def extend_uploads(self):
+        """Add the bandwidth limit option to the upload targets."""
+        for target in ('upload', 'new-sources', 'new-sources-fedora'):
+            self.subparsers.choices[target].add_argument('--limit-rate',
+                    help='Maximum upload speed, in bytes per second, '
+                         'e.g 500K or 2M')
 
     # -- New targets ---------------------------------------------------------
     # --- First register them ---
@@ -49,6 +80,66 @@ class nbpkgClient(cliClient):
                                              "in Fedora, it different.")
         fetchfedora_parser.set_defaults(command=self.fetchfedora)
 
+    def register_index(self):
+        """Register the index command and its subcommands."""
+        index_parser = self.subparsers.add_parser('index',
+                help='Index the packaging metadata of module checkouts',
+                description='This maintains a database of the branches, '
+                            'versions, sources and retirement state of all '
+                            'the module checkouts, so that questions about '
+                            'the whole distribution can be answered quickly.')
+        index_subparsers = index_parser.add_subparsers(
+                title='Index commands')
+
+        build_parser = index_subparsers.add_parser('build',
+                help='Update the index from module checkouts',
+                description='This scans all the module checkouts in the '
+                            'given directories, skipping the ones which did '
+                            'not change since the last scan.')
+        build_parser.add_argument('topdirs', nargs='*', default=['.'],
+                                  metavar='topdir',
+                                  help='A directory containing module '
+                                       'checkouts (defaults to cwd)')
+        build_parser.set_defaults(command=self.index_build)
+
+        query_parser = index_subparsers.add_parser('query',
+                help='Query the index',
+                description='This lists the branches and how many modules '
+                            'have them, unless one of the options is given.')
+        query_group = query_parser.add_mutually_exclusive_group()
+        query_group.add_argument('--retired', action='store_true',
+                                 help='List the retired modules and branches')
+        query_group.add_argument('--source', metavar='HASH_OR_FILENAME',
+                                 help='List the modules using a source file')
+        query_group.add_argument('--branch',
+                                 help='List the modules having a branch')
+        query_group.add_argument('--sql',
+                                 help='Run an arbitrary SQL query')
+        query_parser.set_defaults(command=self.index_query)
+
+    def register_mass_branch(self):
+        """Register the mass-branch command."""
+        mass_branch_parser = self.subparsers.add_parser('mass-branch',
+                help='Create a new branch in many modules at once',
+                description='This creates the new branch in all the modules, '
+                            'directly on the remote and without checking '
+                            'them out. Interrupted runs can be resumed by '
+                            'running the same command again, and all the '
+                            'modules are verified at the end.')
+        mass_branch_parser.add_argument('branch',
+                help='The branch to create, e.g nb6.0')
+        mass_branch_parser.add_argument('modules', nargs='*',
+                help='The modules to branch (defaults to all the indexed '
+                     'modules having the source branch)')
+        mass_branch_parser.add_argument('--from', dest='source',
+                default='nbplayground',
+                help='The branch to branch from (defaults to nbplayground)')
+        mass_branch_parser.add_argument('--jobs', type=int, default=8,
+                help='How many modules to branch at once (defaults to 8)')
+        mass_branch_parser.add_argument('--verify-only', action='store_true',
+                help='Only verify that the modules were branched')
+        mass_branch_parser.set_defaults(command=self.mass_branch)
+
     def register_newsourcesfedora(self):
         """Register the new-sources-fedora command."""
         new_sources_fedora_parser = self.subparsers.add_parser(
@@ -62,6 +153,23 @@ class nbpkgClient(cliClient):
         new_sources_fedora_parser.set_defaults(command=self.new_sources_fedora,
                                                replace=True)
 
+    def register_prefetch(self):
+        """Register the prefetch command."""
+        prefetch_parser = self.subparsers.add_parser('prefetch',
+                help='Download the new sources in the background',
+                description='This starts downloading the files listed in the '
+                            'sources file which we do not have yet, in a '
+                            'detached process. A later sources command will '
+                            'wait for these downloads instead of starting '
+                            'them again.')
+        prefetch_parser.add_argument('--since', metavar='REV',
+                help='Only consider the files which changed in the sources '
+                     'file since this revision')
+        prefetch_parser.add_argument('--install-hooks', action='store_true',
+                help='Install git hooks to prefetch after every checkout '
+                     'and merge')
+        prefetch_parser.set_defaults(command=self.prefetch)
+
     def register_retire(self):
         """Register the retire target"""
 
@@ -92,6 +200,18 @@ class nbpkgClient(cliClient):
                      "different.")
         sourcesfedora_parser.set_defaults(command=self.sourcesfedora)
 
+    def register_watch_tasks(self):
+        """Register the watch-tasks command."""
+        watch_tasks_parser = self.subparsers.add_parser('watch-tasks',
+                help='Wait for Koji tasks to finish',
+                description='This will wait for the given Koji tasks and all '
+                            'their children to finish, sharing the polling '
+                            'of the hub with all the other nbpkg processes '
+                            'on this machine.')
+        watch_tasks_parser.add_argument('task_ids', nargs='+', type=int,
+                                        metavar='task_id')
+        watch_tasks_parser.set_defaults(command=self.watch_tasks)
+
     # --- Then implement them ---
     def fetchfedora(self):
         try:
@@ -103,6 +223,57 @@ class nbpkgClient(cliClient):
             self.log.error('Could not run fetchfedora: %s' % e)
             sys.exit(1)
 
+    def index_build(self):
+        try:
+            self.index.build(self.args.topdirs)
+        except Exception, e:
+            self.log.error('Could not build the index: %s' % e)
+            sys.exit(1)
+
+    def index_query(self):
+        if self.args.retired:
+            rows = self.index.retired()
+        elif self.args.source:
+            rows = self.index.with_source(self.args.source)
+        elif self.args.branch:
+            rows = self.index.with_branch(self.args.branch)
+        elif self.args.sql:
+            rows = self.index.query(self.args.sql)
+        else:
+            rows = self.index.branches()
+
+        for row in rows:
+            print('\t'.join(['%s' % col for col in row]))
+
+    def mass_branch(self):
+        modules = self.args.modules
+        if not modules:
+            freedom = 'free' if self.cmd.freedom else 'nonfree'
+            modules = [name for (name, verrel, f)
+                       in self.index.with_branch(self.args.source)
+                       if f == freedom]
+            if not modules:
+                self.log.error('Could not find any module with a %s branch '
+                               'in the index' % self.args.source)
+                sys.exit(1)
+
+        site = os.path.basename(sys.argv[0])
+        items = dict(self.config.items(site, raw=True))
+
+        try:
+            failures = self.cmd.mass_branch(modules, self.args.branch,
+                    self.args.source,
+                    items.get('mass_branch_dir', '~/.cache/nbpkg/mass-branch'),
+                    self.args.jobs, verify_only=self.args.verify_only)
+        except Exception, e:
+            self.log.error('Could not mass-branch: %s' % e)
+            sys.exit(1)
+
+        if failures:
+            self.log.error('%d modules were not branched properly, run the '
+                           'same command again to retry them' % failures)
+            return 1
+
     def new_sources_fedora(self):
         # This is all mostly copy-pasted from pyrpkg.rpkgCli.new_sources(),
         # except for the lines clearly marked as being different.
@@ -121,6 +292,25 @@ class nbpkgClient(cliClient):
         self.log.info("Source upload succeeded. Don't forget to commit the "
                       "sources file")
 
+    def prefetch(self):
+        try:
+            if self.args.install_hooks:
+                self.cmd.install_prefetch_hooks()
+
+            old_sources = None
+            if self.args.since:
+                try:
+                    old_sources = self.cmd.repo.git.show('%s:sources'
+                                                         % self.args.since)
+                except Exception:
+                    # There was no sources file at that revision
+                    old_sources = ''
+
+            self.cmd.prefetch(old_sources)
+        except Exception, e:
+            self.log.error('Could not prefetch the sources: %s' % e)
+            sys.exit(1)
+
     def retire(self):
         try:
             self.cmd.retire(self.args.msg)
@@ -138,6 +328,22 @@ class nbpkgClient(cliClient):
             self.log.error('Could not run sourcesfedora: %s' % e)
             sys.exit(1)
 
+    def watch_tasks(self):
+        return self._watch_koji_tasks(self.cmd.anon_kojisession,
+                                      self.args.task_ids)
+
+    # -- New properties ------------------------------------------------------
+    @property
+    def index(self):
+        """This property ensures the index attribute"""
+        if not hasattr(self, '_index'):
+            site = os.path.basename(sys.argv[0])
+            items = dict(self.config.items(site, raw=True))
+            self._index = index.ModuleIndex(
+                    items.get('index_db', '~/.cache/nbpkg/index.sqlite'),
+                    items['branchre'], self.log)
+        return self._index
+
     # -- Overloaded properties -----------------------------------------------
     def load_cmd(self):
         """This sets up the cmd object.
@@ -170,6 +376,18 @@ class nbpkgClient(cliClient):
                                        items.get('fedora_lookaside_cgi', ''),
                                        items.get('fedora_kojiconfig', ''),
                                        items.get('fedora_anongiturl', ''),
+                                       items.get('artifact_cache', ''),
+                                       items.get('artifact_cache_rpms',
+                                                 '').lower() == 'true',
+                                       int(items.get('upload_chunk_size',
+                                                     0)) * 1024 * 1024,
+                                       int(items.get('upload_jobs', 1)),
+                                       getattr(self.args, 'limit_rate', None)
+                                       or items.get('upload_rate_limit'),
+                                       items.get('prefetch_sources',
+                                                 '').lower() == 'true',
+                                       items.get('mirror_state',
+                                                 '~/.cache/nbpkg/mirrors.json'),
                                        # -- end of nbpkg-specific arguments --
                                        user=self.args.user,
                                        dist=self.args.dist,
@@ -185,6 +403,87 @@ class nbpkgClient(cliClient):
 
         super(nbpkgClient, self).clone()
 
+    def local(self):
+        """Overload the rpkg method, to reuse cached packages.
+
+        This must happen before the sources are downloaded, as they are not
+        needed at all when the packages are in the artifact cache.
+        """
+        hashtype = 'md5' if getattr(self.args, 'md5', False) else None
+        if self.cmd.reuse_local(self.args.arch, hashtype):
+            return
+
+        super(nbpkgClient, self).local()
+
+    def mockbuild(self):
+        """Overload the rpkg method, to add the matrix mode."""
+        if not self.args.matrix:
+            return super(nbpkgClient, self).mockbuild()
+
+        arches = self.args.matrix_arches
+        if not arches:
+            site = os.path.basename(sys.argv[0])
+            items = dict(self.config.items(site, raw=True))
+            arches = items.get('mock_matrix_arches',
+                               self.cmd.localarch).split()
+
+        # Just like the parent, except that the sources are not needed at
+        # all when the srpm is in the artifact cache
+        hashtype = 'md5' if getattr(self.args, 'md5', False) else None
+        if not self.cmd.reuse_srpm(hashtype):
+            try:
+                self.cmd.sources()
+            except Exception, e:
+                self.log.error('Could not download sources: %s' % e)
+                sys.exit(1)
+
+        # Pick up any mockargs from the env
+        mockargs = os.environ.get('MOCKARGS', '').split()
+
+        try:
+            results = self.cmd.mockbuild_matrix(arches, mockargs, hashtype,
+                                                jobs=self.args.jobs)
+        except Exception, e:
+            self.log.error('Could not run mockbuild: %s' % e)
+            sys.exit(1)
+
+        self.log.info('\nMock build summary:')
+        for mockconfig, success, duration in results:
+            self.log.info('  %-24s %-6s %3dm%02ds'
+                          % (mockconfig, 'PASS' if success else 'FAIL',
+                             duration // 60, duration % 60))
+
+        if not all([success for (mockconfig, success, duration) in results]):
+            return 1
+
+    def _watch_koji_tasks(self, session, tasklist):
+        """Watch a list of tasks and their children.
+
+        We overload it so that all the nbpkg processes running on the machine
+        share a single poller, instead of each of them hammering the hub.
+        """
+        if not tasklist:
+            return
+
+        site = os.path.basename(sys.argv[0])
+        statedir = dict(self.config.items(site, raw=True)).get(
+                'taskwatch_dir', '~/.cache/nbpkg/tasks')
+
+        self.log.info('Watching tasks (this may be safely interrupted)...')
+        watcher = taskwatch.TaskWatcher(statedir, session, self.log)
+
+        try:
+            return watcher.wait(tasklist)
+
+        except KeyboardInterrupt:
+            self.log.info('Tasks still running. You can continue to watch '
+                          'with the \'%s watch-tasks\' command.\n'
+                          'Running Tasks: %s'
+                          % (site, ' '.join(['%d' % t for t in tasklist])))
+            # A ^c should return non-zero so that it doesn't continue
+            # on to any && commands.
+            return 1
+
     def push(self):
         # TODO: this could be submitted to rpkg
         try:
@@ -193,6 +492,18 @@ class nbpkgClient(cliClient):
             self.log.error('Could not push: %s' % e)
             sys.exit(1)
 
+    def srpm(self):
+        """Overload the rpkg method, to reuse a cached srpm.
+
+        This must happen before the sources are downloaded, as they are not
+        needed at all when the srpm is in the artifact cache.
+        """
+        hashtype = 'md5' if getattr(self.args, 'md5', False) else None
+        if self.cmd.reuse_srpm(hashtype):
+            return
+
+        super(nbpkgClient, self).srpm()
+
 
 if __name__ == '__main__':
     client = nbpkgClient()
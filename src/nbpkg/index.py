@@ -0,0 +1,291 @@
+# index.py - an index of the packaging metadata of many module checkouts
+#
+# Copyright (C) 2014 Network Box Corporation Limited
+# Author(s): Mathieu Bridon <mathieu.bridon@network-box.com>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+"""Index the packaging metadata of all module checkouts in a SQLite database.
+
+Everything is read from the git objects of each branch, so nothing needs to be
+checked out. Scanning is incremental: checkouts whose refs did not change are
+skipped, and so are branches which still point to the same commit.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import subprocess
+import tempfile
+
+import git
+
+from sourcesfile import parse_sources
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS modules (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    freedom TEXT NOT NULL,
+    refs TEXT NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS modules_name ON modules (name);
+
+CREATE TABLE IF NOT EXISTS branches (
+    module_id INTEGER NOT NULL REFERENCES modules (id),
+    name TEXT NOT NULL,
+    commit_id TEXT NOT NULL,
+    verrel TEXT,
+    retired INTEGER NOT NULL,
+    PRIMARY KEY (module_id, name)
+);
+CREATE INDEX IF NOT EXISTS branches_name ON branches (name);
+CREATE INDEX IF NOT EXISTS branches_retired ON branches (retired);
+
+CREATE TABLE IF NOT EXISTS sources (
+    module_id INTEGER NOT NULL REFERENCES modules (id),
+    branch TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    filename TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sources_module ON sources (module_id, branch);
+CREATE INDEX IF NOT EXISTS sources_hash ON sources (hash);
+CREATE INDEX IF NOT EXISTS sources_filename ON sources (filename);
+"""
+
+
+def branch_defines(branch):
+    """Return the rpm macros defined when building a branch
+
+    This must be kept in sync with Commands.load_rpmdefines
+    """
+    for branchre, dist, distvar in ((r'nb(\d\.\d)$', 'nb%s', 'nbrs'),
+                                    (r'nb-fedora(\d\d)$', 'fc%s', 'fedora'),
+                                    (r'nb-rhel(\d)$', 'el%s', 'rhel'),
+                                    (r'nb-epel(\d)$', 'el%s', 'rhel')):
+        m = re.match(branchre, branch)
+        if m:
+            distval = m.group(1)
+            return [('dist', '.%s' % (dist % distval)),
+                    (distvar, distval.replace('.', ''))]
+
+    # The nbplayground dist would require querying Koji, but at least don't
+    # let rpm use the dist of the host
+    return [('dist', '%{nil}')]
+
+
+class ModuleIndex(object):
+    def __init__(self, dbpath, branchre, log):
+        dbpath = os.path.expanduser(dbpath)
+        if not os.path.isdir(os.path.dirname(dbpath)):
+            os.makedirs(os.path.dirname(dbpath))
+
+        self.db = sqlite3.connect(dbpath)
+        self.db.executescript(SCHEMA)
+
+        self.branchre = branchre
+        self.log = log
+
+    # -- Building the index --------------------------------------------------
+    def build(self, topdirs):
+        """Scan all the module checkouts found in topdirs"""
+        for topdir in topdirs:
+            topdir = os.path.abspath(topdir)
+            seen = set()
+
+            for name in sorted(os.listdir(topdir)):
+                path = os.path.join(topdir, name)
+                if not os.path.isdir(os.path.join(path, '.git')):
+                    continue
+
+                seen.add(path)
+                try:
+                    self._scan(path)
+                except git.cmd.GitCommandError as e:
+                    self.log.warn('Could not index %s: %s' % (path, e))
+
+            # Forget about the checkouts which were removed, but not about
+            # the ones in subdirectories of topdir
+            prefix = os.path.join(topdir, '')
+            for module_id, path in self.db.execute(
+                    'SELECT id, path FROM modules '
+                    'WHERE substr(path, 1, ?) = ?',
+                    (len(prefix), prefix)).fetchall():
+                if os.path.dirname(path) == topdir and path not in seen:
+                    self._forget(module_id)
+
+            self.db.commit()
+
+    def _forget(self, module_id):
+        for table, column in (('sources', 'module_id'),
+                              ('branches', 'module_id'),
+                              ('modules', 'id')):
+            self.db.execute('DELETE FROM %s WHERE %s = ?' % (table, column),
+                            (module_id,))
+
+    def _refs_mtime(self, path):
+        """Return the last time any ref changed in the checkout
+
+        Git updates refs by renaming a lock file into place, which changes
+        the mtime of the containing directory.
+        """
+        gitdir = os.path.join(path, '.git')
+        mtimes = []
+
+        for name in ('HEAD', 'packed-refs'):
+            if os.path.exists(os.path.join(gitdir, name)):
+                mtimes.append(os.path.getmtime(os.path.join(gitdir, name)))
+
+        for dirpath, dirnames, filenames in os.walk(os.path.join(gitdir,
+                                                                 'refs')):
+            mtimes.append(os.path.getmtime(dirpath))
+
+        return max(mtimes)
+
+    def _scan(self, path):
+        row = self.db.execute('SELECT id, refs, mtime FROM modules '
+                              'WHERE path = ?', (path,)).fetchone()
+
+        mtime = self._refs_mtime(path)
+        if row is not None and row[2] == mtime:
+            return
+
+        repo = git.Repo(path)
+        refs = repo.git.for_each_ref('--format=%(objectname) %(refname)',
+                                     'refs/heads', 'refs/remotes')
+        refshash = hashlib.sha1(refs).hexdigest()
+
+        if row is not None and row[1] == refshash:
+            self.db.execute('UPDATE modules SET mtime = ? WHERE id = ?',
+                            (mtime, row[0]))
+            return
+
+        self.log.info('Indexing %s' % path)
+
+        # Same heuristic as when we pick the config file
+        freedom = 'free'
+        for remote in repo.remotes:
+            if "nonfree" in remote.name or \
+               "nonfree" in remote.config_reader.get("url"):
+                freedom = 'nonfree'
+                break
+
+        # Prefer the remote branches over the local ones
+        branches = {}
+        refs = [line.split() for line in refs.splitlines()]
+        for commit, refname in sorted(refs, key=lambda r: r[1].startswith(
+                                                            'refs/remotes/')):
+            name = refname.rsplit('/', 1)[1]
+            if re.match(self.branchre, name):
+                branches[name] = commit
+
+        if row is None:
+            module_id = self.db.execute('INSERT INTO modules (name, path, '
+                                        'freedom, refs, mtime) '
+                                        'VALUES (?, ?, ?, ?, ?)',
+                                        (os.path.basename(path), path,
+                                         freedom, refshash, mtime)).lastrowid
+            indexed = {}
+
+        else:
+            module_id = row[0]
+            self.db.execute('UPDATE modules SET freedom = ?, refs = ?, '
+                            'mtime = ? WHERE id = ?',
+                            (freedom, refshash, mtime, module_id))
+            indexed = dict(self.db.execute('SELECT name, commit_id '
+                                           'FROM branches '
+                                           'WHERE module_id = ?',
+                                           (module_id,)).fetchall())
+
+        for name in set(indexed) - set(branches):
+            self._forget_branch(module_id, name)
+
+        for name, commit in branches.items():
+            if indexed.get(name) != commit:
+                self._forget_branch(module_id, name)
+                self._scan_branch(repo, module_id, name, commit)
+
+    def _forget_branch(self, module_id, name):
+        self.db.execute('DELETE FROM sources WHERE module_id = ? '
+                        'AND branch = ?', (module_id, name))
+        self.db.execute('DELETE FROM branches WHERE module_id = ? '
+                        'AND name = ?', (module_id, name))
+
+    def _scan_branch(self, repo, module_id, name, commit):
+        files = repo.git.ls_tree('--name-only', commit).splitlines()
+
+        verrel = None
+        specs = [f for f in files if f.endswith('.spec')]
+        if specs:
+            verrel = self._verrel(repo.git.cat_file('blob', '%s:%s'
+                                                    % (commit, specs[0])),
+                                  branch_defines(name))
+
+        sources = []
+        if 'sources' in files:
+            sources = parse_sources(repo.git.cat_file('blob', '%s:sources'
+                                                      % commit))
+
+        self.db.execute('INSERT INTO branches (module_id, name, commit_id, '
+                        'verrel, retired) VALUES (?, ?, ?, ?, ?)',
+                        (module_id, name, commit, verrel,
+                         'dead.package' in files))
+        self.db.executemany('INSERT INTO sources (module_id, branch, hash, '
+                            'filename) VALUES (?, ?, ?, ?)',
+                            [(module_id, name, h, f) for (h, f) in sources])
+
+    def _verrel(self, spec, defines):
+        """Ask rpm for the version and release in a spec file"""
+        with tempfile.NamedTemporaryFile(suffix='.spec') as f:
+            f.write(spec)
+            f.flush()
+
+            cmd = ['rpm', '-q', '--qf', '%{VERSION}-%{RELEASE}\\n',
+                   '--specfile', f.name]
+            for macro, value in defines:
+                cmd.extend(['--define', '%s %s' % (macro, value)])
+
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            out, err = proc.communicate()
+
+        if proc.returncode:
+            self.log.debug('Could not parse the spec file: %s' % err.strip())
+            return None
+
+        return out.splitlines()[0]
+
+    # -- Querying the index --------------------------------------------------
+    def query(self, sql, params=()):
+        return self.db.execute(sql, params).fetchall()
+
+    def retired(self):
+        """Return the (module, branch) pairs which are retired"""
+        return self.query('SELECT m.name, b.name FROM branches b '
+                          'JOIN modules m ON m.id = b.module_id '
+                          'WHERE b.retired ORDER BY m.name, b.name')
+
+    def with_source(self, source):
+        """Return the (module, branch, filename) with a source hash or name"""
+        return self.query('SELECT m.name, s.branch, s.filename FROM sources s '
+                          'JOIN modules m ON m.id = s.module_id '
+                          'WHERE s.hash = ? OR s.filename = ? '
+                          'ORDER BY m.name, s.branch', (source, source))
+
+    def with_branch(self, branch):
+        """Return the (module, verrel, freedom) which have a branch"""
+        return self.query('SELECT m.name, b.verrel, m.freedom FROM branches b '
+                          'JOIN modules m ON m.id = b.module_id '
+                          'WHERE b.name = ? ORDER BY m.name', (branch,))
+
+    def branches(self):
+        """Return the branches and how many modules have them"""
+        return self.query('SELECT name, count(*) FROM branches '
+                          'GROUP BY name ORDER BY name')
@@ -0,0 +1,207 @@
+# massbranch.py - create a new branch in many modules at once
+#
+# Copyright (C) 2014 Network Box Corporation Limited
+# Author(s): Mathieu Bridon <mathieu.bridon@network-box.com>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+"""Create a new branch in many modules at once, e.g when cutting a release.
+
+Nothing is checked out: for every module we only fetch the tip of the source
+branch into a small, shallow bare repository, and push it to the new branch.
+As the remote already has all the objects, the push is tiny.
+
+All the git operations go through a shared SSH master connection per host, so
+that hundreds of modules don't mean hundreds of SSH handshakes. Progress is
+saved after every module, so an interrupted run can simply be restarted.
+"""
+
+import json
+import multiprocessing.pool
+import os
+import re
+import subprocess
+import threading
+
+
+SSH_WRAPPER = """#!/bin/sh
+exec ssh -o ControlMaster=auto -o ControlPath='%s/%%r@%%h:%%p' \\
+         -o ControlPersist=120 "$@"
+"""
+
+
+class MassBranchError(Exception):
+    pass
+
+
+class MassBrancher(object):
+    def __init__(self, gitbaseurl, workdir, log, jobs):
+        self.gitbaseurl = gitbaseurl
+        self.workdir = os.path.expanduser(workdir)
+        self.log = log
+        self.jobs = jobs
+
+        self._lock = threading.Lock()
+
+        # Modules can have the same name on different remotes (e.g free and
+        # nonfree), so keep their repositories and progress apart
+        self.remotedir = os.path.join(self.workdir,
+                                      re.sub(r'[^\w.-]+', '_', gitbaseurl))
+
+        for path in (os.path.join(self.remotedir, 'repos'),
+                     os.path.join(self.workdir, 'ssh')):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        self.ssh_wrapper = os.path.join(self.workdir, 'ssh', 'ssh')
+        with open(self.ssh_wrapper, 'w') as f:
+            f.write(SSH_WRAPPER % os.path.join(self.workdir, 'ssh'))
+        os.chmod(self.ssh_wrapper, 0755)
+
+    def _git(self, args, cwd=None):
+        env = dict(os.environ, GIT_SSH=self.ssh_wrapper)
+
+        proc = subprocess.Popen(['git'] + args, cwd=cwd, env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+
+        if proc.returncode:
+            raise MassBranchError(err.strip())
+
+        return out
+
+    def _ls_remote(self, url, *branches):
+        """Return the commits the remote branches point to"""
+        refs = {}
+
+        out = self._git(['ls-remote', url] +
+                        ['refs/heads/%s' % b for b in branches])
+        for line in out.splitlines():
+            sha, ref = line.split()
+            refs[ref[len('refs/heads/'):]] = sha
+
+        return refs
+
+    # -- Progress ------------------------------------------------------------
+    def _statefile(self, branch):
+        return os.path.join(self.remotedir, '%s.json' % branch)
+
+    def load_state(self, branch):
+        try:
+            with open(self._statefile(branch)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_state(self, branch, state):
+        statefile = self._statefile(branch)
+        tmppath = '%s.%d' % (statefile, os.getpid())
+
+        with open(tmppath, 'w') as f:
+            json.dump(state, f, indent=4, sort_keys=True)
+        os.rename(tmppath, statefile)
+
+    # -- Branching -----------------------------------------------------------
+    def branch_one(self, module, source, branch):
+        """Create the branch from source in a module
+
+        Returns the commit the new branch points to.
+        """
+        url = self.gitbaseurl % {'module': module}
+
+        remote = self._ls_remote(url, source, branch)
+        if branch in remote:
+            # Already branched, by us or somebody else
+            return remote[branch]
+        if source not in remote:
+            raise MassBranchError('There is no %s branch' % source)
+
+        repo = os.path.join(self.remotedir, 'repos', '%s.git' % module)
+        if not os.path.isdir(repo):
+            self._git(['init', '--quiet', '--bare', repo])
+
+        # The remote has the history already, we only need its tip
+        self._git(['fetch', '--quiet', '--depth', '1', url,
+                   '+refs/heads/%s:refs/heads/%s' % (source, source)],
+                  cwd=repo)
+        sha = self._git(['rev-parse', 'refs/heads/%s' % source],
+                        cwd=repo).strip()
+
+        self._git(['push', '--quiet', url,
+                   '%s:refs/heads/%s' % (sha, branch)], cwd=repo)
+        return sha
+
+    def run(self, modules, source, branch):
+        """Create the branch in all the modules, resuming previous runs
+
+        Returns the list of modules which failed.
+        """
+        state = self.load_state(branch)
+        todo = [m for m in modules
+                if state.get(m, {}).get('status') != 'done']
+
+        if len(todo) < len(modules):
+            self.log.info('Resuming: %d modules were already branched'
+                          % (len(modules) - len(todo)))
+
+        def branch_module(module):
+            try:
+                result = {'status': 'done',
+                          'commit': self.branch_one(module, source, branch)}
+                self.log.info('%s: branched %s from %s'
+                              % (module, branch, source))
+            except MassBranchError as e:
+                result = {'status': 'failed', 'error': '%s' % e}
+                self.log.error('%s: could not branch: %s' % (module, e))
+
+            with self._lock:
+                state[module] = result
+                self._save_state(branch, state)
+
+        pool = multiprocessing.pool.ThreadPool(self.jobs)
+        try:
+            for _ in pool.imap_unordered(branch_module, todo):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return [m for m in modules if state[m]['status'] != 'done']
+
+    def verify(self, modules, branch):
+        """Check the branch exists in all the modules where it should
+
+        Returns a list of (module, problem) tuples.
+        """
+        state = self.load_state(branch)
+
+        def verify_module(module):
+            url = self.gitbaseurl % {'module': module}
+            try:
+                remote = self._ls_remote(url, branch)
+            except MassBranchError as e:
+                return module, '%s' % e
+
+            if branch not in remote:
+                return module, 'the %s branch is missing' % branch
+
+            expected = state.get(module, {}).get('commit')
+            if expected is not None and remote[branch] != expected:
+                return module, ('%s points to %s instead of %s'
+                                % (branch, remote[branch], expected))
+
+            return module, None
+
+        pool = multiprocessing.pool.ThreadPool(self.jobs)
+        try:
+            results = pool.map(verify_module, modules)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return [(m, problem) for (m, problem) in results if problem]
@@ -0,0 +1,235 @@
+# metrics.py - export metrics about nbpkg operations
+#
+# Copyright (C) 2014 Network Box Corporation Limited
+# Author(s): Mathieu Bridon <mathieu.bridon@network-box.com>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+"""Collect metrics about nbpkg operations and export them to a sink.
+
+Metrics are only accumulated in memory while the command runs. When it is
+done, a forked child process writes them to the configured sink, so exporting
+them never delays the command:
+
+  - prometheus:/path/to/nbpkg.prom, a textfile for the node exporter, with the
+    cumulated values of all nbpkg runs on the host;
+  - statsd:host:port, sent over UDP to a local agent;
+  - jsonl:/path/to/nbpkg.jsonl, one JSON object per metric and per run.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import socket
+import time
+
+
+# In seconds, this covers everything from a Koji call to a whole build
+BUCKETS = [0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600]
+
+
+class Registry(object):
+    def __init__(self):
+        self.sink = None
+        self.labels = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def _key(self, name, labels):
+        merged = dict(self.labels)
+        merged.update(labels)
+        return (name, tuple(sorted(merged.items())))
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter"""
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram"""
+        self.histograms.setdefault(self._key(name, labels), []).append(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the block takes, in seconds"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def flush(self):
+        """Write the metrics to the sink in the background"""
+        if self.sink is None or not (self.counters or self.histograms):
+            return
+
+        if os.fork():
+            # The parent carries on without waiting for the child
+            self.counters, self.histograms = {}, {}
+            return
+
+        try:
+            # Detach from the terminal, so that whoever waits for the output
+            # of the command does not also wait for us
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+
+            self.sink.write(self.counters, self.histograms)
+        finally:
+            os._exit(0)
+
+
+def get_sink(spec):
+    """Return the sink described by spec, or None if it is empty"""
+    if not spec:
+        return None
+
+    kind, target = spec.split(':', 1)
+    sinks = {'prometheus': PrometheusSink, 'statsd': StatsdSink,
+             'jsonl': JsonLinesSink}
+
+    if kind not in sinks:
+        raise ValueError('Unknown metrics sink: %s' % kind)
+
+    return sinks[kind](target)
+
+
+class PrometheusSink(object):
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def write(self, counters, histograms):
+        # The textfile must have the totals of all runs, which we keep in a
+        # JSON state file next to it
+        statepath = '%s.json' % self.path
+
+        with open('%s.lock' % self.path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                with open(statepath) as f:
+                    state = json.load(f)
+            except (IOError, ValueError):
+                state = {'counters': [], 'histograms': []}
+
+            totals = dict(((n, tuple(map(tuple, l))), v)
+                          for (n, l, v) in state['counters'])
+            for key, value in counters.items():
+                totals[key] = totals.get(key, 0) + value
+
+            buckets = dict(((n, tuple(map(tuple, l))), v)
+                           for (n, l, v) in state['histograms'])
+            for key, values in histograms.items():
+                b = buckets.setdefault(key, [0] * (len(BUCKETS) + 2))
+                for value in values:
+                    for i, le in enumerate(BUCKETS):
+                        if value <= le:
+                            b[i] += 1
+                    b[-2] += value
+                    b[-1] += 1
+
+            state = {'counters': [(n, l, v) for ((n, l), v)
+                                  in totals.items()],
+                     'histograms': [(n, l, v) for ((n, l), v)
+                                    in buckets.items()],
+                     }
+            self._atomic_write(statepath, json.dumps(state))
+            self._atomic_write(self.path, self._render(totals, buckets))
+
+    def _atomic_write(self, path, content):
+        tmppath = '%s.%d' % (path, os.getpid())
+        with open(tmppath, 'w') as f:
+            f.write(content)
+        os.rename(tmppath, path)
+
+    def _labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(['%s="%s"' % (k, v) for (k, v) in labels])
+
+    def _render(self, totals, buckets):
+        lines = []
+
+        for (name, labels), value in sorted(totals.items()):
+            lines.append('%s%s %s' % (name, self._labels(labels), value))
+
+        for (name, labels), b in sorted(buckets.items()):
+            for i, le in enumerate(BUCKETS):
+                lines.append('%s_bucket%s %d'
+                             % (name, self._labels(labels, [('le', le)]),
+                                b[i]))
+            lines.append('%s_bucket%s %d'
+                         % (name, self._labels(labels, [('le', '+Inf')]),
+                            b[-1]))
+            lines.append('%s_sum%s %s' % (name, self._labels(labels), b[-2]))
+            lines.append('%s_count%s %d' % (name, self._labels(labels),
+                                            b[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdSink(object):
+    def __init__(self, address):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+
+    def _name(self, name, labels):
+        # Plain statsd has no labels, so make them part of the name
+        parts = [name] + [str(v).replace('.', '_') for (k, v) in labels]
+        return '.'.join(parts)
+
+    def write(self, counters, histograms):
+        lines = []
+
+        for (name, labels), value in counters.items():
+            lines.append('%s:%s|c' % (self._name(name, labels), value))
+
+        for (name, labels), values in histograms.items():
+            for value in values:
+                lines.append('%s:%d|ms' % (self._name(name, labels),
+                                           value * 1000))
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in lines:
+                sock.sendto(line, self.address)
+        finally:
+            sock.close()
+
+
+class JsonLinesSink(object):
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def write(self, counters, histograms):
+        now = time.time()
+        lines = []
+
+        for (name, labels), value in counters.items():
+            lines.append(json.dumps({'time': now, 'name': name,
+                                     'labels': dict(labels),
+                                     'type': 'counter', 'value': value}))
+
+        for (name, labels), values in histograms.items():
+            lines.append(json.dumps({'time': now, 'name': name,
+                                     'labels': dict(labels),
+                                     'type': 'histogram', 'values': values}))
+
+        # A single append, so that concurrent runs don't mix their lines
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, '\n'.join(lines) + '\n')
+        finally:
+            os.close(fd)
+
+
+# All nbpkg code records its metrics here
+registry = Registry()
@@ -0,0 +1,407 @@
+# mirrors.py - download sources from the best of several lookaside mirrors
+#
+# Copyright (C) 2014 Network Box Corporation Limited
+# Author(s): Mathieu Bridon <mathieu.bridon@network-box.com>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+"""Download files from a set of lookaside mirrors.
+
+We keep a score for every mirror (latency to the first byte, throughput and
+recent failures) in a state file, so that all nbpkg runs benefit from what the
+previous ones learnt. Downloads then:
+
+  - go to the best healthy mirror first;
+  - are hedged: if the request did not even start after a few times the usual
+    latency, the same file is requested from the next mirror, and the first
+    one to finish wins;
+  - for large files, are split in byte ranges fetched from all the healthy
+    mirrors at once, the faster mirrors naturally taking more ranges.
+"""
+
+import Queue
+import json
+import os
+import threading
+import time
+import urllib2
+import urlparse
+
+from metrics import registry
+
+
+# Smoothing factor of the moving averages of latency and throughput
+ALPHA = 0.3
+
+# A mirror which failed that many times in a row is skipped for a while
+MAX_FAILURES = 2
+FAILURE_COOLDOWN = 5 * 60
+
+# Scores older than that are refreshed by probing the mirrors
+PROBE_INTERVAL = 24 * 60 * 60
+
+BLOCK_SIZE = 64 * 1024
+
+
+class MirrorError(Exception):
+    pass
+
+
+class MirrorSet(object):
+    def __init__(self, urls, statefile, log, range_threshold=64*1024*1024,
+                 timeout=30):
+        self.urls = urls
+        self.statefile = os.path.expanduser(statefile)
+        self.log = log
+        self.range_threshold = range_threshold
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self.scores = self._load()
+
+    # -- Scores --------------------------------------------------------------
+    def _load(self):
+        try:
+            with open(self.statefile) as f:
+                scores = json.load(f)
+        except (IOError, ValueError):
+            scores = {}
+
+        for url in self.urls:
+            scores.setdefault(url, {'latency': None, 'throughput': None,
+                                    'failures': 0, 'failed_at': 0,
+                                    'updated_at': 0})
+
+        return scores
+
+    def save(self):
+        statedir = os.path.dirname(self.statefile)
+        if not os.path.isdir(statedir):
+            os.makedirs(statedir)
+
+        tmppath = '%s.%d' % (self.statefile, os.getpid())
+        with self._lock:
+            with open(tmppath, 'w') as f:
+                json.dump(self.scores, f)
+        os.rename(tmppath, self.statefile)
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return ALPHA * new + (1 - ALPHA) * old
+
+    def _success(self, url, latency, nbytes=0, duration=0):
+        with self._lock:
+            score = self.scores[url]
+            score['latency'] = self._average(score['latency'], latency)
+            if nbytes and duration:
+                score['throughput'] = self._average(score['throughput'],
+                                                    nbytes / duration)
+            score['failures'] = 0
+            score['updated_at'] = time.time()
+
+            registry.inc('nbpkg_lookaside_bytes_total', nbytes or 0,
+                         lookaside=urlparse.urlparse(url).netloc)
+
+    def _failure(self, url, error):
+        self.log.debug('Mirror %s failed: %s' % (url, error))
+
+        with self._lock:
+            score = self.scores[url]
+            score['failures'] += 1
+            score['failed_at'] = time.time()
+
+            registry.inc('nbpkg_lookaside_failures_total',
+                         lookaside=urlparse.urlparse(url).netloc)
+
+    def _healthy(self, url):
+        score = self.scores[url]
+        return (score['failures'] < MAX_FAILURES or
+                time.time() - score['failed_at'] > FAILURE_COOLDOWN)
+
+    def ranked(self, size=None):
+        """Return the healthy mirrors, best first
+
+        Mirrors are ranked by how long they should take to serve a file of
+        that size. If they are all unhealthy, return them all anyway.
+        """
+        def cost(url):
+            score = self.scores[url]
+            latency = score['latency'] or 0
+            if size and score['throughput']:
+                return latency + size / score['throughput']
+            return latency
+
+        healthy = [url for url in self.urls if self._healthy(url)]
+        return sorted(healthy or self.urls, key=cost)
+
+    def probe(self, force=False):
+        """Measure the latency of the mirrors we know too little about"""
+        stale = [url for url in self.urls
+                 if force or self.scores[url]['latency'] is None or
+                    time.time() - self.scores[url]['updated_at'] >
+                    PROBE_INTERVAL]
+
+        def probe_one(url):
+            request = urllib2.Request(url)
+            request.get_method = lambda: 'HEAD'
+
+            start = time.time()
+            try:
+                urllib2.urlopen(request, timeout=self.timeout).close()
+            except urllib2.HTTPError:
+                # It answered, that's all we want to know
+                pass
+            except Exception as e:
+                self._failure(url, e)
+                return
+            self._success(url, time.time() - start)
+
+        threads = [threading.Thread(target=probe_one, args=(url,))
+                   for url in stale]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    # -- Downloads -----------------------------------------------------------
+    def _fetch(self, url, dest, cancel, started=None, byterange=None):
+        """Fetch url into dest, optionally only a byte range of it
+
+        Returns the number of bytes fetched (None if it was cancelled), the
+        latency to the first byte and the total duration.
+        """
+        request = urllib2.Request(url)
+        if byterange is not None:
+            request.add_header('Range', 'bytes=%d-%d' % byterange)
+
+        start = time.time()
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        latency = time.time() - start
+
+        if started is not None:
+            started.set()
+
+        if byterange is not None and response.getcode() != 206:
+            response.close()
+            raise MirrorError('Byte ranges are not supported')
+
+        nbytes = 0
+        with open(dest, 'r+b' if byterange is not None else 'wb') as f:
+            if byterange is not None:
+                f.seek(byterange[0])
+
+            while True:
+                if cancel.is_set():
+                    response.close()
+                    return None, latency, time.time() - start
+
+                data = response.read(BLOCK_SIZE)
+                if not data:
+                    break
+
+                f.write(data)
+                nbytes += len(data)
+
+        # A connection dropped in the middle of the body is not a success
+        if byterange is not None:
+            expected = byterange[1] - byterange[0] + 1
+        else:
+            expected = response.info().getheader('Content-Length')
+            expected = int(expected) if expected is not None else nbytes
+
+        if nbytes != expected:
+            raise MirrorError('Got %d bytes instead of %d' % (nbytes, expected))
+
+        return nbytes, latency, time.time() - start
+
+    def _hedge_delay(self, mirrors):
+        latency = self.scores[mirrors[0]]['latency']
+        if latency is None:
+            return 1.0
+        return max(3 * latency, 0.25)
+
+    def _hedged(self, relpath, dest, mirrors):
+        """Download from the best mirror, hedging with the next ones"""
+        results = Queue.Queue()
+        cancel = threading.Event()
+        done = threading.Lock()
+        candidates = list(mirrors)
+        state = {'running': 0, 'started': None}
+
+        def attempt(mirror, tmppath, started):
+            url = '%s/%s' % (mirror, relpath)
+            try:
+                fetched = self._fetch(url, dest=tmppath, cancel=cancel,
+                                      started=started)
+            except Exception as e:
+                self._failure(mirror, e)
+                nbytes = None
+                error = e
+            else:
+                # Even if it was cancelled, its latency is worth knowing
+                nbytes, latency, duration = fetched
+                self._success(mirror, latency, nbytes, duration)
+                error = None
+
+            with done:
+                # Nobody will use the file if another attempt already won
+                if nbytes is None or cancel.is_set():
+                    if os.path.exists(tmppath):
+                        os.unlink(tmppath)
+                    nbytes = None
+
+                if not cancel.is_set():
+                    results.put((mirror, tmppath, nbytes, error))
+
+        def launch():
+            mirror = candidates.pop(0)
+            tmppath = '%s.%d.part' % (dest, len(mirrors) - len(candidates))
+            started = threading.Event()
+
+            t = threading.Thread(target=attempt,
+                                 args=(mirror, tmppath, started))
+            t.daemon = True
+            t.start()
+
+            state['running'] += 1
+            state['started'] = started
+
+        launch()
+        errors = []
+
+        try:
+            while True:
+                try:
+                    mirror, tmppath, nbytes, error = results.get(
+                                        timeout=self._hedge_delay(mirrors))
+
+                except Queue.Empty:
+                    if not state['started'].is_set() and candidates:
+                        self.log.debug('Hedging the download of %s'
+                                       % relpath)
+                        launch()
+                    continue
+
+                state['running'] -= 1
+
+                if nbytes is not None:
+                    os.rename(tmppath, dest)
+                    return
+
+                errors.append('%s: %s' % (mirror, error))
+
+                if candidates:
+                    launch()
+                elif not state['running']:
+                    raise MirrorError('Could not download %s:\n%s'
+                                      % (relpath, '\n'.join(errors)))
+
+        finally:
+            with done:
+                cancel.set()
+
+            # Remove the files of the attempts which also completed
+            while not results.empty():
+                mirror, tmppath, nbytes, error = results.get()
+                if nbytes is not None and os.path.exists(tmppath):
+                    os.unlink(tmppath)
+
+    def _size(self, url, timeout):
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+
+        response = urllib2.urlopen(request, timeout=timeout)
+        try:
+            return int(response.info().getheader('Content-Length'))
+        finally:
+            response.close()
+
+    def _ranged(self, relpath, dest, size, mirrors):
+        """Download byte ranges of the file from all the mirrors at once"""
+        partsize = max(self.range_threshold // 4,
+                       size // (4 * len(mirrors)) + 1)
+        parts = Queue.Queue()
+        for offset in range(0, size, partsize):
+            parts.put((offset, min(offset + partsize, size) - 1))
+
+        tmppath = '%s.part' % dest
+        with open(tmppath, 'wb') as f:
+            f.truncate(size)
+
+        cancel = threading.Event()
+
+        def worker(mirror):
+            url = '%s/%s' % (mirror, relpath)
+
+            while not cancel.is_set():
+                try:
+                    byterange = parts.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    fetched = self._fetch(url, tmppath, cancel,
+                                          byterange=byterange)
+                except Exception as e:
+                    # Let the other mirrors have this part
+                    self._failure(mirror, e)
+                    parts.put(byterange)
+                    return
+
+                nbytes, latency, duration = fetched
+                self._success(mirror, latency, nbytes, duration)
+
+        threads = [threading.Thread(target=worker, args=(mirror,))
+                   for mirror in mirrors]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(1)
+        finally:
+            cancel.set()
+
+        if not parts.empty():
+            os.unlink(tmppath)
+            raise MirrorError('Could not download all the parts of %s'
+                              % relpath)
+
+        os.rename(tmppath, dest)
+
+    def download(self, relpath, dest):
+        """Download a file from the mirrors"""
+        self.probe()
+        mirrors = self.ranked()
+
+        try:
+            if len(mirrors) > 1:
+                # Don't wait on a slow mirror just to know the size
+                try:
+                    size = self._size('%s/%s' % (mirrors[0], relpath),
+                                      self._hedge_delay(mirrors))
+                except Exception as e:
+                    self.log.debug('Could not get the size of %s: %s'
+                                   % (relpath, e))
+                    size = None
+
+                if size is not None and size >= self.range_threshold:
+                    try:
+                        return self._ranged(relpath, dest, size, mirrors)
+                    except MirrorError as e:
+                        self.log.debug('%s, falling back to a single mirror'
+                                       % e)
+
+                mirrors = self.ranked(size)
+
+            return self._hedged(relpath, dest, mirrors)
+
+        finally:
+            self.save()
@@ -0,0 +1,187 @@
+# prefetch.py - download new sources in the background
+#
+# Copyright (C) 2014 Network Box Corporation Limited
+# Author(s): Mathieu Bridon <mathieu.bridon@network-box.com>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+"""Download the sources of a module in a detached background process.
+
+Each file being prefetched is protected by a lock file in the git directory,
+which the downloading process holds until the file is complete. This is how
+concurrent prefetches avoid downloading the same file twice, and how the
+sources command knows it must wait for an in-flight download instead of
+starting its own.
+"""
+
+import errno
+import fcntl
+import os
+import subprocess
+import traceback
+
+from sourcesfile import check_hash, parse_sources
+
+
+HOOK_MARKER = '# Installed by nbpkg, to prefetch the sources'
+
+HOOKS = {
+    'post-checkout': '#!/bin/sh\n%s\n'
+                     '[ "$3" = 1 ] && nbpkg prefetch --since "$1" '
+                     '>/dev/null 2>&1\nexit 0\n' % HOOK_MARKER,
+    'post-merge': '#!/bin/sh\n%s\n'
+                  'nbpkg prefetch --since ORIG_HEAD >/dev/null 2>&1\n'
+                  'exit 0\n' % HOOK_MARKER,
+}
+
+
+def _lockdir(path):
+    return os.path.join(path, '.git', 'nbpkg-prefetch')
+
+
+def _lockfile(path, filename):
+    return os.path.join(_lockdir(path), '%s.lock' % filename)
+
+
+def wait(path, filenames, log):
+    """Wait for the in-flight prefetches of these files to finish"""
+    for filename in filenames:
+        lockfile = _lockfile(path, filename)
+        if not os.path.exists(lockfile):
+            continue
+
+        with open(lockfile) as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+
+                log.info('Waiting for the prefetch of %s' % filename)
+                fcntl.flock(lock, fcntl.LOCK_SH)
+
+
+def prefetch(path, lookaside, module_name, hashtype, old_sources, log):
+    """Download the new files of the sources file in the background
+
+    Only the files which are in the sources file but not in old_sources, and
+    which we don't already have, are downloaded.
+    """
+    sourcesfile = os.path.join(path, 'sources')
+    if not os.path.exists(sourcesfile):
+        return
+
+    with open(sourcesfile) as f:
+        new = parse_sources(f.read())
+
+    # Only bother hashing the files which changed
+    old = parse_sources(old_sources or '')
+    changed = [(h, name) for (h, name) in new
+               if (h, name) not in old or
+                  not os.path.exists(os.path.join(path, name))]
+    missing = [(h, name) for (h, name) in changed
+               if not os.path.exists(os.path.join(path, name)) or
+                  not check_hash(os.path.join(path, name), h, hashtype)]
+
+    if not missing:
+        return
+
+    if not os.path.isdir(_lockdir(path)):
+        os.makedirs(_lockdir(path))
+
+    # Take the locks before detaching, so that a sources run starting right
+    # after us knows it has to wait
+    locks = []
+    for file_hash, filename in missing:
+        lock = open(_lockfile(path, filename), 'w')
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        except IOError as e:
+            lock.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+            # Another prefetch is already downloading it
+            continue
+
+        locks.append((file_hash, filename, lock))
+
+    if not locks:
+        return
+
+    log.info('Prefetching %s in the background'
+             % ', '.join([name for (h, name, l) in locks]))
+
+    if os.fork():
+        # Only the grandchild holds the locks now
+        for (h, name, lock) in locks:
+            lock.close()
+        os.wait()
+        return
+
+    # Detach completely from the terminal and the parent
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+
+    try:
+        logfile = os.path.join(_lockdir(path), 'log')
+        out = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        os.dup2(out, 1)
+        os.dup2(out, 2)
+        os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+
+        for file_hash, filename, lock in locks:
+            _download(path, lookaside, module_name, hashtype, file_hash,
+                      filename)
+            lock.close()
+
+    except Exception:
+        traceback.print_exc()
+
+    finally:
+        os._exit(0)
+
+
+def _download(path, lookaside, module_name, hashtype, file_hash, filename):
+    """Download a file from the lookaside cache, atomically"""
+    quoted = filename.replace(' ', '%20')
+    url = '%s/%s/%s/%s/%s' % (lookaside, module_name, quoted, file_hash,
+                              quoted)
+
+    target = os.path.join(path, filename)
+    tmppath = os.path.join(_lockdir(path), '%s.part' % filename)
+
+    if subprocess.call(['curl', '-f', '-L', '-s', '-S', '-o', tmppath,
+                        url]):
+        return
+
+    if check_hash(tmppath, file_hash, hashtype):
+        os.rename(tmppath, target)
+    else:
+        os.unlink(tmppath)
+
+
+def install_hooks(path, log):
+    """Install the git hooks which prefetch after checkouts and merges"""
+    hooksdir = os.path.join(path, '.git', 'hooks')
+
+    for name, content in HOOKS.items():
+        hook = os.path.join(hooksdir, name)
+
+        if os.path.exists(hook):
+            with open(hook) as f:
+                if HOOK_MARKER not in f.read():
+                    log.warn('Not overwriting the existing %s hook' % name)
+                    continue
+
+        with open(hook, 'w') as f:
+            f.write(content)
+        os.chmod(hook, 0755)
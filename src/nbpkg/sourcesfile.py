@@ -0,0 +1,45 @@
+# sourcesfile.py - read the sources file of a module
+#
+# Copyright (C) 2014 Network Box Corporation Limited
+# Author(s): Mathieu Bridon <mathieu.bridon@network-box.com>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+"""Parse the sources file of a module and check the files it lists."""
+
+import hashlib
+import re
+
+
+# Both the old "hash  filename" and the new "HASHTYPE (filename) = hash"
+SOURCES_RE = re.compile(r'^(?:(?P<hash>[0-9a-f]+)\s+(?P<filename>\S+)|'
+                        r'\w+ \((?P<bsdfilename>[^)]+)\) = '
+                        r'(?P<bsdhash>[0-9a-f]+))$')
+
+
+def parse_sources(content):
+    """Return the (hash, filename) entries of a sources file"""
+    entries = []
+
+    for line in content.splitlines():
+        m = SOURCES_RE.match(line.strip())
+        if m:
+            entries.append((m.group('hash') or m.group('bsdhash'),
+                            m.group('filename') or m.group('bsdfilename')))
+
+    return entries
+
+
+def check_hash(path, file_hash, hashtype):
+    """Check whether the file at path has the expected hash"""
+    h = hashlib.new(hashtype)
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), ''):
+            h.update(chunk)
+
+    return h.hexdigest() == file_hash
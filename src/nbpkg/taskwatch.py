@@ -0,0 +1,314 @@
+# taskwatch.py - watch Koji tasks for many nbpkg processes at once
+#
+# Copyright (C) 2014 Network Box Corporation Limited
+# Author(s): Mathieu Bridon <mathieu.bridon@network-box.com>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+"""Watch Koji tasks for any number of nbpkg processes on the same host.
+
+Every waiting process registers the tasks it is interested in by dropping a
+file in a shared state directory. Whichever process manages to grab the leader
+lock then polls all the registered tasks (and their children) for everybody,
+with a single Koji multicall per interval, and writes their state back to the
+state directory. The other processes just read their results from there, and
+one of them takes over the polling if the leader goes away.
+
+This way, dozens of concurrent builds only cost a single session to the hub.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import time
+
+import koji
+
+
+# Not a Koji state, for the tasks the hub does not know about
+UNKNOWN_STATE = -1
+
+FINAL_STATES = [koji.TASK_STATES[s] for s in ('CLOSED', 'CANCELED', 'FAILED')]
+FINAL_STATES.append(UNKNOWN_STATE)
+FAILED_STATES = [koji.TASK_STATES[s] for s in ('CANCELED', 'FAILED')]
+FAILED_STATES.append(UNKNOWN_STATE)
+
+# Forget about finished tasks nobody watches any more after a day
+STATE_EXPIRY = 24 * 60 * 60
+
+
+class TaskWatcher(object):
+    def __init__(self, statedir, session, log, min_interval=1,
+                 max_interval=30):
+        """Init the object and its state directory.
+
+        The polling interval starts at min_interval seconds, doubles every time
+        nothing changed, up to max_interval seconds, and goes back down to
+        min_interval as soon as a task changes.
+        """
+        self.statedir = os.path.expanduser(statedir)
+        self.session = session
+        self.log = log
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.interval = min_interval
+        self._lock = None
+
+        for subdir in ('watch', 'state'):
+            path = os.path.join(self.statedir, subdir)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as e:
+                    # Another nbpkg process might just have created it
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    # -- Registration --------------------------------------------------------
+    def _watch_file(self, task_id, pid=None):
+        return os.path.join(self.statedir, 'watch',
+                            '%d.%d' % (task_id, pid or os.getpid()))
+
+    def register(self, task_ids):
+        """Tell the leader we are interested in these tasks"""
+        for task_id in task_ids:
+            open(self._watch_file(task_id), 'w').close()
+
+    def unregister(self, task_ids):
+        """Tell the leader we are not interested in these tasks any more"""
+        for task_id in task_ids:
+            try:
+                os.unlink(self._watch_file(task_id))
+            except OSError:
+                pass
+
+    def _watched(self):
+        """Return the ids of all the tasks registered by live processes"""
+        watched = set()
+
+        for name in os.listdir(os.path.join(self.statedir, 'watch')):
+            try:
+                task_id, pid = [int(i) for i in name.split('.')]
+            except ValueError:
+                continue
+
+            try:
+                os.kill(pid, 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    # The process died without unregistering
+                    self._unregister_stale(task_id, pid)
+                    continue
+
+            watched.add(task_id)
+
+        return watched
+
+    def _unregister_stale(self, task_id, pid):
+        try:
+            os.unlink(self._watch_file(task_id, pid))
+        except OSError:
+            pass
+
+    # -- Task states ---------------------------------------------------------
+    def _state_file(self, task_id):
+        return os.path.join(self.statedir, 'state', '%d' % task_id)
+
+    def read_state(self, task_id):
+        """Return the last known state of a task, or None"""
+        try:
+            with open(self._state_file(task_id)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            # Either not polled yet, or being written right now
+            return None
+
+    def _write_state(self, task_id, state):
+        path = self._state_file(task_id)
+        tmppath = '%s.%d' % (path, os.getpid())
+
+        with open(tmppath, 'w') as f:
+            json.dump(state, f)
+
+        os.rename(tmppath, path)
+
+    def _tree(self, task_ids):
+        """Return the ids of the tasks and all their known descendants"""
+        tree = []
+        todo = list(task_ids)
+
+        while todo:
+            task_id = todo.pop(0)
+            if task_id in tree:
+                continue
+
+            tree.append(task_id)
+            state = self.read_state(task_id)
+            if state is not None:
+                todo.extend(state['children'])
+
+        return tree
+
+    # -- Leadership ----------------------------------------------------------
+    def _try_lead(self):
+        """Try to become the process polling the hub for everybody"""
+        if self._lock is not None:
+            return True
+
+        lock = open(os.path.join(self.statedir, 'leader.lock'), 'w')
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            lock.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+
+        self.log.debug('Polling Koji tasks on behalf of all nbpkg processes')
+        self._lock = lock
+        return True
+
+    def _resign(self):
+        if self._lock is not None:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+            self._lock.close()
+            self._lock = None
+
+    def _expire(self, watched):
+        """Drop the old states of finished tasks nobody watches any more"""
+        statedir = os.path.join(self.statedir, 'state')
+        now = time.time()
+
+        for name in os.listdir(statedir):
+            try:
+                task_id = int(name)
+            except ValueError:
+                continue
+
+            if task_id in watched:
+                continue
+
+            path = os.path.join(statedir, name)
+            try:
+                if now - os.path.getmtime(path) > STATE_EXPIRY:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def poll(self):
+        """Poll all the registered tasks with one multicall
+
+        Returns True if any task changed since the last poll.
+        """
+        watched = self._watched()
+        self._expire(watched)
+
+        pending = []
+        previous = {}
+        for task_id in self._tree(watched):
+            state = self.read_state(task_id)
+            if state is None or state['state'] not in FINAL_STATES:
+                pending.append(task_id)
+                previous[task_id] = state
+
+        if not pending:
+            return False
+
+        self.session.multicall = True
+        for task_id in pending:
+            self.session.getTaskInfo(task_id, request=True)
+            self.session.getTaskChildren(task_id)
+        results = self.session.multiCall()
+
+        changed = False
+        for i, task_id in enumerate(pending):
+            info, children = results[2*i:2*i+2]
+
+            if isinstance(info, dict) or isinstance(children, dict):
+                # This is a fault, we'll try again next time
+                fault = info if isinstance(info, dict) else children
+                self.log.debug('Could not poll task %d: %s'
+                               % (task_id, fault.get('faultString')))
+                continue
+
+            info, children = info[0], children[0]
+            if info is None:
+                # It will never show up, so don't keep waiting for it
+                state = {'id': task_id,
+                         'state': UNKNOWN_STATE,
+                         'label': 'unknown task',
+                         'children': [],
+                         }
+
+            else:
+                state = {'id': task_id,
+                         'state': info['state'],
+                         'label': koji.taskLabel(info),
+                         'children': sorted([c['id'] for c in children]),
+                         }
+
+            if state != previous[task_id]:
+                self._write_state(task_id, state)
+                changed = True
+
+        return changed
+
+    # -- Waiting -------------------------------------------------------------
+    def _report(self, task_id, state):
+        if state['state'] == UNKNOWN_STATE:
+            self.log.error('Koji does not know about task %d' % task_id)
+            return
+
+        self.log.info('%d %s: %s' % (task_id, state['label'],
+                                     koji.TASK_STATES[state['state']].lower()))
+
+    def wait(self, task_ids):
+        """Wait for the tasks and all their children to finish
+
+        Returns 0 if they all succeeded, 1 otherwise.
+        """
+        self.register(task_ids)
+        reported = {}
+
+        try:
+            while True:
+                if self._try_lead():
+                    if self.poll():
+                        self.interval = self.min_interval
+                    else:
+                        self.interval = min(self.interval * 2,
+                                            self.max_interval)
+
+                tree = self._tree(task_ids)
+                states = dict((t, self.read_state(t)) for t in tree)
+
+                for task_id in tree:
+                    state = states[task_id]
+                    if state is None:
+                        continue
+
+                    if reported.get(task_id) != state['state']:
+                        self._report(task_id, state)
+                        reported[task_id] = state['state']
+
+                if all(s is not None and s['state'] in FINAL_STATES
+                       for s in states.values()):
+                    break
+
+                # Followers only read local files, no need to back off
+                time.sleep(self.interval if self._lock is not None
+                           else self.min_interval)
+
+        finally:
+            self.unregister(task_ids)
+            self._resign()
+
+        failed = [s for s in states.values() if s['state'] in FAILED_STATES]
+        return 1 if failed else 0
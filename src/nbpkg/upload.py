@@ -0,0 +1,171 @@
+# upload.py - chunked, resumable uploads to the lookaside cache
+#
+# Copyright (C) 2014 Network Box Corporation Limited
+# Author(s): Mathieu Bridon <mathieu.bridon@network-box.com>
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.  See http://www.gnu.org/copyleft/gpl.html for
+# the full text of the license.
+
+"""Upload very large files to the lookaside cache in chunks.
+
+On top of the usual name, md5sum and filename fields, the upload CGI accepts:
+
+  - chunks=status, to which it answers "CHUNKS" followed by the offsets of
+    the chunks it already received, one per line;
+  - offset and chunk_md5 along with the file field, to receive one chunk;
+  - assemble=1 and size, to concatenate the chunks, verify the checksum of
+    the whole file and store it like a regular upload.
+
+CGIs which don't answer the status request properly only get legacy, single
+request uploads. See contrib/lookaside-upload.cgi for a reference server.
+"""
+
+import hashlib
+import multiprocessing.pool
+import os
+import subprocess
+
+
+# Try each chunk that many times before giving up
+CHUNK_ATTEMPTS = 3
+
+
+class ChunkedUploadUnsupported(Exception):
+    pass
+
+
+class ChunkedUploadError(Exception):
+    pass
+
+
+def parse_rate(rate):
+    """Parse a curl-like rate (e.g 500K, 2M) into bytes per second"""
+    units = {'k': 1024, 'm': 1024**2, 'g': 1024**3}
+
+    rate = rate.strip()
+    if rate[-1].lower() in units:
+        return int(float(rate[:-1]) * units[rate[-1].lower()])
+
+    return int(rate)
+
+
+class ChunkedUploader(object):
+    def __init__(self, lookaside_cgi, cert_file, module_name, log,
+                 chunk_size, jobs=1, rate_limit=None, quiet=False):
+        self.lookaside_cgi = lookaside_cgi
+        self.cert_file = cert_file
+        self.module_name = module_name
+        self.log = log
+        self.chunk_size = chunk_size
+        self.jobs = jobs
+        self.quiet = quiet
+
+        # The limit is for the whole upload, share it among the jobs
+        self.rate_limit = None
+        if rate_limit:
+            self.rate_limit = max(parse_rate(rate_limit) // jobs, 1)
+
+    def _post(self, fields, data=None):
+        """Post a form to the CGI, optionally with data as the file field
+
+        Returns the body of the response.
+        """
+        cmd = ['curl', '-k', '--cert', self.cert_file, '--fail', '--silent',
+               '--show-error']
+
+        if self.rate_limit:
+            cmd.extend(['--limit-rate', '%d' % self.rate_limit])
+
+        for field in fields:
+            cmd.extend(['-F', '%s=%s' % field])
+
+        if data is not None:
+            cmd.extend(['-F', 'file=@-;filename=%s'
+                              % dict(fields)['filename']])
+
+        cmd.append(self.lookaside_cgi)
+
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate(data)
+
+        if proc.returncode:
+            raise ChunkedUploadError(err.strip())
+
+        return out
+
+    def _received(self, fields):
+        """Return the offsets of the chunks the CGI already has"""
+        try:
+            out = self._post(fields + [('chunks', 'status')])
+        except ChunkedUploadError as e:
+            raise ChunkedUploadUnsupported(e)
+
+        lines = out.splitlines()
+        if not lines or lines[0].strip() != 'CHUNKS':
+            raise ChunkedUploadUnsupported(out.strip())
+
+        return set([int(l) for l in lines[1:] if l.strip()])
+
+    def _upload_chunk(self, fields, path, offset):
+        # Only ever hold one chunk per job in memory
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(self.chunk_size)
+
+        chunk_fields = fields + [('offset', '%d' % offset),
+                                 ('chunk_md5', hashlib.md5(data).hexdigest())]
+
+        for attempt in range(1, CHUNK_ATTEMPTS + 1):
+            try:
+                self._post(chunk_fields, data)
+                return
+
+            except ChunkedUploadError as e:
+                self.log.debug('Chunk at offset %d of %s failed (attempt '
+                               '%d/%d): %s' % (offset, path, attempt,
+                                               CHUNK_ATTEMPTS, e))
+
+        raise ChunkedUploadError('Could not upload the chunk at offset %d'
+                                 % offset)
+
+    def upload(self, path, file_hash):
+        """Upload the file, resuming any previously interrupted upload
+
+        Raises ChunkedUploadUnsupported if the CGI doesn't support chunked
+        uploads, in which case the caller should fall back to a legacy upload.
+        """
+        size = os.path.getsize(path)
+        fields = [('name', self.module_name), ('md5sum', file_hash),
+                  ('filename', os.path.basename(path))]
+
+        received = self._received(fields)
+        offsets = [o for o in range(0, size, self.chunk_size)
+                   if o not in received]
+
+        if received:
+            self.log.info('Resuming the upload of %s (%d/%d chunks missing)'
+                          % (os.path.basename(path), len(offsets),
+                             len(received) + len(offsets)))
+
+        pool = multiprocessing.pool.ThreadPool(self.jobs)
+        try:
+            done = 0
+            for _ in pool.imap_unordered(
+                    lambda o: self._upload_chunk(fields, path, o), offsets):
+                done += 1
+                if not self.quiet:
+                    self.log.info('Uploaded %d/%d chunks of %s'
+                                  % (done, len(offsets),
+                                     os.path.basename(path)))
+        finally:
+            # Stop sending chunks as soon as one of them failed
+            pool.terminate()
+            pool.join()
+
+        # The CGI verifies the checksum of the assembled file
+        self._post(fields + [('assemble', '1'), ('size', '%d' % size)])